@@ -1,17 +1,29 @@
 import asyncio
-import contextlib
+import functools
 import logging
 import os
 import socket
 import time
 
-from tornado import iostream
+from tornado import ioloop, iostream
 
 LOGGER = logging.getLogger(__name__)
 
 SETTINGS_KEY = 'sprockets.mixins.metrics.statsd'
 """``self.settings`` key that configures this mix-in."""
 
+_PATH_TRANSLATION = str.maketrans('.', '-')
+_SOCK_NONBLOCK = getattr(socket, 'SOCK_NONBLOCK', 0)
+
+
+def _normalize(element):
+    """Return a path element as ASCII with periods replaced by dashes."""
+    return str(element).translate(_PATH_TRANSLATION).encode('ascii')
+
+
+_normalize_cached = functools.lru_cache(maxsize=1024)(_normalize)
+"""Memoized :func:`_normalize` for immutable ``str`` and ``int`` elements."""
+
 
 class StatsdMixin:
     """Mix this class in to record metrics to a Statsd server."""
@@ -49,9 +61,8 @@ class StatsdMixin:
         """
         client = get_client(self.application)
         if client is not None:
-            client.send(path, kwargs.get('amount', '1'), 'c')
+            client.send(path, kwargs.get('amount', 1), 'c')
 
-    @contextlib.contextmanager
     def execution_timer(self, *path):
         """
         Record the time it takes to perform an arbitrary code block.
@@ -63,11 +74,7 @@ class StatsdMixin:
         to the specified `path` using (:meth:`record_timing`).
 
         """
-        start = time.time()
-        try:
-            yield
-        finally:
-            self.record_timing(max(start, time.time()) - start, *path)
+        return _ExecutionTimer(self, path)
 
     def on_finish(self):
         """
@@ -79,12 +86,36 @@ class StatsdMixin:
         path defined by the class's module, it's name, the request method,
         and the status code.  The :meth:`.record_timing` method is used
         to send the metric, so the configured namespace is used as well.
+        The collector is flushed afterwards so the request's metrics are
+        written right away.
 
         """
         super().on_finish()
         self.record_timing(self.request.request_time(),
                            self.__class__.__name__, self.request.method,
                            self.get_status())
+        client = get_client(self.application)
+        if client is not None:
+            client.flush()
+
+
+class _ExecutionTimer:
+    """Context manager returned by :meth:`StatsdMixin.execution_timer`."""
+
+    __slots__ = ('_handler', '_path', '_start')
+
+    def __init__(self, handler, path):
+        self._handler = handler
+        self._path = path
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._handler.record_timing(
+            (time.perf_counter_ns() - self._start) / 1e9, *self._path)
 
 
 class StatsDCollector:
@@ -94,35 +125,87 @@ class StatsDCollector:
     When installed, it is attached to the :class:`~tornado.web.Application`
     instance for your web application.
 
+    Metrics are buffered and written in batches of at most `max_payload`
+    bytes.  A batch is written when it is full, when :meth:`flush` is
+    called, or `flush_interval` seconds after the first metric was
+    buffered, whichever comes first.  Counter increments for the same path
+    are summed until the next flush and written as a single metric.  Over
+    UDP each batch is a single datagram of newline-separated metrics.  The
+    UDP socket is non-blocking; if the kernel send buffer is full or the
+    agent is not listening, the datagram is dropped instead of stalling
+    the IOLoop or raising.
+
     :param str host: The StatsD host
     :param str port: The StatsD port
     :param str protocol: The StatsD protocol. May be either ``udp`` or ``tcp``.
     :param str namespace: The StatsD bucket to write metrics into.
     :param bool prepend_metric_type: Optional flag to prepend bucket path
         with the StatsD metric type
+    :param int max_payload: Optional maximum batch size in bytes.  Defaults
+        to :attr:`MAX_PAYLOAD`.
+    :param float flush_interval: Optional maximum number of seconds that a
+        metric is buffered for.  Defaults to :attr:`FLUSH_INTERVAL`.
+        :class:`StatsdMixin` flushes when each request finishes, so this
+        only bounds metrics recorded while a request is still running or
+        from outside of a request handler.
+    :param int send_buffer_size: Optional ``SO_SNDBUF`` size for the UDP
+        socket.  Defaults to :attr:`SEND_BUFFER_SIZE`.  The kernel may cap
+        this (``net.core.wmem_max`` on Linux).
 
     """
     METRIC_TYPES = {'c': 'counters',
                     'ms': 'timers'}
+    MAX_PAYLOAD = 1400
+    """Default maximum batch size in bytes; stays under a typical MTU."""
+    FLUSH_INTERVAL = 0.1
+    """Default maximum number of seconds that a metric is buffered for."""
+    SEND_BUFFER_SIZE = 4 * 1024 * 1024
+    """Default ``SO_SNDBUF`` size requested for the UDP socket."""
+    DROP_LOG_INTERVAL = 60
+    """Minimum number of seconds between warnings about dropped datagrams."""
 
     def __init__(self, host, port, protocol='udp', namespace='sprockets',
-                 prepend_metric_type=True):
+                 prepend_metric_type=True, max_payload=None,
+                 flush_interval=None, send_buffer_size=None):
         self._host = host
         self._port = int(port)
         self._address = (self._host, self._port)
         self._namespace = namespace
         self._prepend_metric_type = prepend_metric_type
+        self._path_prefix = '{}.'.format(namespace).encode('ascii')
+        self._type_prefixes = {
+            metric_type: '{}.{}.'.format(namespace, name).encode('ascii')
+            for metric_type, name in self.METRIC_TYPES.items()}
         self._tcp_reconnect_sleep = 5
         self._closing = False
+        self._buffer = bytearray()
+        self._counters = {}
+        self._max_payload = (self.MAX_PAYLOAD if max_payload is None
+                             else int(max_payload))
+        self._flush_interval = (self.FLUSH_INTERVAL if flush_interval is None
+                                else float(flush_interval))
+        self._connected = False
+        self._flush_timeout = None
+        self._dropped = 0
+        self._drop_logged_at = None
 
         if protocol == 'tcp':
             self._tcp = True
-            self._msg_format = '{path}:{value}|{metric_type}\n'
+            self._msg_format = b'%s:%s|%s\n'
+            self._separator = b''
             self._sock = self._tcp_socket()
         elif protocol == 'udp':
             self._tcp = False
-            self._msg_format = '{path}:{value}|{metric_type}'
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
+            self._msg_format = b'%s:%s|%s'
+            self._separator = b'\n'
+            self._sock = socket.socket(
+                socket.AF_INET, socket.SOCK_DGRAM | _SOCK_NONBLOCK, 0)
+            if not _SOCK_NONBLOCK:
+                self._sock.setblocking(False)
+            self._sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF,
+                self.SEND_BUFFER_SIZE if send_buffer_size is None
+                else int(send_buffer_size))
         else:
             raise ValueError('Invalid protocol: {}'.format(protocol))
 
@@ -130,8 +213,10 @@ class StatsDCollector:
         """Connect to statsd via TCP and return the IOStream handle.
         :rtype: iostream.IOStream
         """
-        sock = iostream.IOStream(socket.socket(
-                    socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP))
+        raw_sock = socket.socket(
+            socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        raw_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock = iostream.IOStream(raw_sock)
         sock.connect(self._address)
         sock.set_close_callback(self._tcp_on_closed)
         return sock
@@ -149,63 +234,177 @@ class StatsDCollector:
     def close(self):
         """Gracefully close the socket."""
         if not self._closing:
+            self.flush()
             self._closing = True
             self._sock.close()
 
+    def flush(self):
+        """Write the aggregated counters and buffered metrics, if any."""
+        counters, self._counters = self._counters, {}
+        for path, value in counters.items():
+            self._buffer_metric(self._format_metric(path, value, 'c'))
+        self._write_buffer()
+
+        if self._flush_timeout is not None:
+            io_loop, timeout = self._flush_timeout
+            if io_loop is ioloop.IOLoop.current(instance=False):
+                io_loop.remove_timeout(timeout)
+            self._flush_timeout = None
+
+    def _write_buffer(self):
+        """Write the current batch of metrics to the socket."""
+        if not self._buffer:
+            return
+
+        data, self._buffer = self._buffer, bytearray()
+        if self._tcp:
+            self._write_stream(data)
+        else:
+            self._send_datagram(data)
+
+    def _write_stream(self, data):
+        """Write a batch of metrics to the TCP stream.
+
+        :param bytes data: newline-terminated metrics
+
+        """
+        if self._sock.closed():
+            return
+        try:
+            self._sock.write(data)
+        except iostream.StreamClosedError as error:  # pragma: nocover
+            LOGGER.warning('Error sending TCP statsd metric: %s', error)
+
+    def _send_datagram(self, data):
+        """Send a batch of metrics as one UDP datagram.
+
+        :param bytes data: newline-separated metrics
+
+        """
+        try:
+            if not self._connected:
+                self._sock.connect(self._address)
+                self._connected = True
+            self._sock.send(data)
+        except BlockingIOError:
+            self._drop_datagram('send buffer is full')
+        except ConnectionRefusedError:
+            self._drop_datagram('connection refused')
+        except (OSError, socket.error) as error:  # pragma: nocover
+            LOGGER.exception('Error sending statsd metric: %s', error)
+
+    def _drop_datagram(self, reason):
+        """Count a datagram that could not be sent.
+
+        A warning is logged at most once every :attr:`DROP_LOG_INTERVAL`
+        seconds so that a stalled or missing agent does not flood the log.
+
+        :param str reason: why the datagram was dropped
+
+        """
+        self._dropped += 1
+        now = time.monotonic()
+        if (self._drop_logged_at is None or
+                now - self._drop_logged_at >= self.DROP_LOG_INTERVAL):
+            LOGGER.warning('Statsd %s, %s datagram(s) dropped so far',
+                           reason, self._dropped)
+            self._drop_logged_at = now
+
     def send(self, path, value, metric_type):
         """Send a metric to Statsd.
 
+        Numeric counter values are summed per path and written as a
+        single metric when the collector is flushed.  Without a current
+        IOLoop the metric is written right away.  The collector is not
+        thread-safe; hand calls from other threads to the IOLoop with
+        :meth:`~tornado.ioloop.IOLoop.add_callback`.
+
         :param list path: The metric path to record
         :param mixed value: The value to record
         :param str metric_type: The metric type
 
         """
-        msg = self._msg_format.format(
-            path=self._build_path(path, metric_type),
-            value=value,
-            metric_type=metric_type)
+        path = self._build_path(path, metric_type)
+        if metric_type == 'c' and type(value) in (int, float):
+            self._counters[path] = self._counters.get(path, 0) + value
+        elif self._tcp and self._sock.closed():
+            return
+        else:
+            self._buffer_metric(self._format_metric(path, value, metric_type))
+        self._schedule_flush()
 
-        LOGGER.debug('Sending %s to %s:%s', msg.encode('ascii'),
-                     self._host, self._port)
+    def _format_metric(self, path, value, metric_type):
+        """Return a metric encoded for the wire.
 
-        try:
-            if self._tcp:
-                if self._sock.closed():
-                    return
-                return self._sock.write(msg.encode('ascii'))
+        :param bytes path: The normalized metric path
+        :param mixed value: The value to record
+        :param str metric_type: The metric type
+        :rtype: bytes
 
-            self._sock.sendto(msg.encode('ascii'), (self._host, self._port))
-        except iostream.StreamClosedError as error:  # pragma: nocover
-            LOGGER.warning('Error sending TCP statsd metric: %s', error)
-        except (OSError, socket.error) as error:  # pragma: nocover
-            LOGGER.exception('Error sending statsd metric: %s', error)
+        """
+        if type(value) is int:
+            value = b'%d' % value
+        else:
+            value = str(value).encode('ascii')
+        return self._msg_format % (path, value, metric_type.encode('ascii'))
 
-    def _build_path(self, path, metric_type):
-        """Return a normalized path.
+    def _buffer_metric(self, data):
+        """Append an encoded metric to the current batch.
 
-        :param list path: elements of the metric path to record
-        :param str metric_type: The metric type
-        :rtype: str
+        :param bytes data: the encoded metric
 
         """
-        path = self._get_prefixes(metric_type) + list(path)
-        return '{}.{}'.format(self._namespace,
-                              '.'.join(str(p).replace('.', '-') for p in path))
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('Sending %s to %s:%s', data, self._host, self._port)
+
+        if self._buffer:
+            if (len(self._buffer) + len(self._separator) + len(data) >
+                    self._max_payload):
+                self._write_buffer()
+            else:
+                self._buffer += self._separator
+        self._buffer += data
 
-    def _get_prefixes(self, metric_type):
-        """Get prefixes where applicable
+    def _schedule_flush(self):
+        """Make sure that pending metrics are flushed within the interval.
 
-        Add metric prefix counters, timers respectively if
-        :attr:`prepend_metric_type` flag is True.
+        The flush timer is armed on the current IOLoop.  A timer left on
+        a different loop, for example one that has since been closed, is
+        discarded.  Without a usable IOLoop the pending metrics are
+        written immediately.
 
+        """
+        io_loop = ioloop.IOLoop.current(instance=False)
+        if self._flush_timeout is not None:
+            if self._flush_timeout[0] is io_loop:
+                return
+            self._flush_timeout = None
+
+        if io_loop is not None:
+            try:
+                timeout = io_loop.call_later(self._flush_interval, self.flush)
+            except RuntimeError:  # the current loop is closed
+                pass
+            else:
+                self._flush_timeout = (io_loop, timeout)
+                return
+        self.flush()
+
+    def _build_path(self, path, metric_type):
+        """Return a normalized path.
+
+        :param list path: elements of the metric path to record
         :param str metric_type: The metric type
-        :rtype: list
+        :rtype: bytes
 
         """
-        prefixes = []
         if self._prepend_metric_type:
-            prefixes.append(self.METRIC_TYPES[metric_type])
-        return prefixes
+            prefix = self._type_prefixes[metric_type]
+        else:
+            prefix = self._path_prefix
+        return prefix + b'.'.join([
+            _normalize_cached(p) if type(p) in (str, int) else _normalize(p)
+            for p in path])
 
 
 def install(application, **kwargs):
@@ -225,6 +424,10 @@ def install(application, **kwargs):
         ``STATSD_PORT`` environment variable, or default `8125`,
         will be pass into the :class:`.StatsDCollector`.
     - **namespace** The StatsD bucket to write metrics into.
+    - **max_payload** The maximum number of bytes to write at once.
+    - **flush_interval** The maximum number of seconds to buffer a metric.
+        Handler metrics are also flushed when the request finishes.
+    - **send_buffer_size** The ``SO_SNDBUF`` size of the UDP socket.
 
     """
     if getattr(application, 'statsd', None) is not None:
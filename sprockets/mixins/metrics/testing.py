@@ -1,3 +1,5 @@
+import collections
+import functools
 import logging
 import re
 import socket
@@ -7,6 +9,57 @@ from tornado import iostream, locks, tcpserver, testing
 LOGGER = logging.getLogger(__name__)
 
 
+class _DatagramList(list):
+    """List of received datagrams that keeps metrics indexed by path.
+
+    :meth:`append` adds the new datagram to the index.  Every other
+    mutation discards the index so that it is rebuilt on next use.
+
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._index = None
+
+    def append(self, datagram):
+        super().append(datagram)
+        if self._index is not None:
+            self._add_to_index(datagram)
+
+    @property
+    def index(self):
+        """Metrics keyed by path as lists of ``(value, type)`` tuples."""
+        if self._index is None:
+            self._index = collections.defaultdict(list)
+            for datagram in self:
+                self._add_to_index(datagram)
+        return self._index
+
+    def _add_to_index(self, datagram):
+        for line in datagram.split(b'\n'):
+            path, colon, tail = line.partition(b':')
+            value, pipe, stat_type = tail.partition(b'|')
+            if colon and pipe:
+                self._index[path].append((value, stat_type))
+
+
+def _invalidates_index(name):
+    method = getattr(list, name)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._index = None
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+for _name in ('__delitem__', '__iadd__', '__imul__', '__setitem__', 'clear',
+              'extend', 'insert', 'pop', 'remove', 'reverse', 'sort'):
+    setattr(_DatagramList, _name, _invalidates_index(_name))
+del _name
+
+
 class FakeStatsdServer(tcpserver.TCPServer):
     """
     Implements something resembling a statsd server.
@@ -26,11 +79,18 @@ class FakeStatsdServer(tcpserver.TCPServer):
 
     .. attribute:: datagrams
 
-       A list of datagrams that have been received by the server.
+       A list of datagrams that have been received by the server.  A
+       single datagram may contain several newline-separated metrics.
+       :meth:`find_metrics` keeps an index of this list by metric path;
+       it is updated as datagrams arrive and rebuilt after the list is
+       modified in any other way or replaced.
 
     """
 
-    TCP_PATTERN = br'(?P<path>[^:]*):(?P<value>[^|]*)\|(?P<type>.*)\n$'
+    TCP_PATTERN = re.compile(
+        br'(?P<path>[^:]*):(?P<value>[^|]*)\|(?P<type>.*)\n$')
+    RECEIVE_BUFFER_SIZE = 12 * 1024 * 1024
+    """``SO_RCVBUF`` size requested for the UDP socket."""
 
     def __init__(self, iol, protocol='udp'):
         self.datagrams = []
@@ -53,8 +113,12 @@ class FakeStatsdServer(tcpserver.TCPServer):
     def udp_server(self, iol):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
                                     socket.IPPROTO_UDP)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                               self.RECEIVE_BUFFER_SIZE)
         self.socket.bind(('127.0.0.1', 0))
+        self.socket.setblocking(False)
         self.sockaddr = self.socket.getsockname()
+        self._recv_buffer = memoryview(bytearray(65535))
 
         iol.add_handler(self.socket, self._handle_events, iol.READ)
         self._iol = iol
@@ -70,7 +134,7 @@ class FakeStatsdServer(tcpserver.TCPServer):
     async def handle_stream(self, stream, address):
         while True:
             try:
-                result = await stream.read_until_regex(self.TCP_PATTERN)
+                result = await stream.read_until(b'\n')
             except iostream.StreamClosedError:
                 break
             else:
@@ -88,13 +152,28 @@ class FakeStatsdServer(tcpserver.TCPServer):
             raise RuntimeError
 
         if events & self._iol.READ:
-            data, _ = self.socket.recvfrom(4096)
-            self.datagrams.append(data)
+            while True:
+                try:
+                    size = self.socket.recv_into(self._recv_buffer)
+                except BlockingIOError:
+                    break
+                self.datagrams.append(bytes(self._recv_buffer[:size]))
+
+    @property
+    def datagrams(self):
+        return self._datagrams
+
+    @datagrams.setter
+    def datagrams(self, value):
+        self._datagrams = _DatagramList(value)
 
     def find_metrics(self, prefix, metric_type):
         """
         Yields captured datagrams that start with `prefix`.
 
+        Metrics are yielded grouped by path, in the order that each path
+        was first received.
+
         :param str prefix: the metric prefix to search for
         :param str metric_type: the statsd metric type (e.g., 'ms', 'c')
         :returns: yields (path, value, metric_type) tuples for each
@@ -102,17 +181,18 @@ class FakeStatsdServer(tcpserver.TCPServer):
         :raises AssertionError: if no metrics match.
 
         """
-        pattern = re.compile(
-            '(?P<path>{}[^:]*):(?P<value>[^|]*)\\|(?P<type>{})'.format(
-                re.escape(prefix), re.escape(metric_type)))
+        prefix_bytes = prefix.encode('ascii')
+        type_bytes = metric_type.encode('ascii')
         matched = False
 
-        for datagram in self.datagrams:
-            text_msg = datagram.decode('ascii')
-            match = pattern.match(text_msg)
-            if match:
-                yield match.groups()
-                matched = True
+        for path, metrics in list(self._datagrams.index.items()):
+            if not path.startswith(prefix_bytes):
+                continue
+            for value, stat_type in list(metrics):
+                if stat_type.startswith(type_bytes):
+                    yield (path.decode('ascii'), value.decode('ascii'),
+                           metric_type)
+                    matched = True
 
         if not matched:
             raise AssertionError(
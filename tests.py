@@ -1,9 +1,10 @@
 import asyncio
 import itertools
+import logging
 import socket
 import unittest.mock
 
-from tornado import iostream, testing, web
+from tornado import ioloop, iostream, testing, web
 
 from sprockets.mixins.metrics import statsd
 from sprockets.mixins.metrics.testing import FakeStatsdServer
@@ -29,6 +30,32 @@ class DefaultStatusCode(statsd.StatsdMixin, web.RequestHandler):
         pass
 
 
+ROUTES = [
+    web.url('/', examples.statsd.SimpleHandler),
+    web.url(r'/counters/([^/]+)/([0-9.]+)', CounterBumper),
+    web.url('/status_code', DefaultStatusCode),
+]
+
+
+class CapturingSocket:
+    """Stand-in for a connected UDP socket that records what is sent."""
+
+    def __init__(self):
+        self.datagrams = []
+        self.bytes_sent = 0
+
+    def connect(self, address):
+        pass
+
+    def send(self, data):
+        self.datagrams.append(bytes(data))
+        self.bytes_sent += len(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
 def assert_between(low, value, high):
     if not (low <= value < high):
         raise AssertionError('Expected {} to be between {} and {}'.format(
@@ -38,11 +65,7 @@ def assert_between(low, value, high):
 class MisconfiguredStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
 
     def get_app(self):
-        self.application = web.Application([
-            web.url('/', examples.statsd.SimpleHandler),
-            web.url('/counters/(.*)/([.0-9]*)', CounterBumper),
-            web.url('/status_code', DefaultStatusCode),
-        ])
+        self.application = web.Application(ROUTES)
 
     def test_bad_protocol_raises_ValueError(self):
         with self.assertRaises(ValueError):
@@ -54,11 +77,7 @@ class MisconfiguredStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
 class TCPStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
 
     def get_app(self):
-        self.application = web.Application([
-            web.url('/', examples.statsd.SimpleHandler),
-            web.url('/counters/(.*)/([.0-9]*)', CounterBumper),
-            web.url('/status_code', DefaultStatusCode),
-        ])
+        self.application = web.Application(ROUTES)
         return self.application
 
     def setUp(self):
@@ -78,8 +97,19 @@ class TCPStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
     def test_write_not_executed_when_connection_is_closed(self, mock_write):
         self.application.statsd._sock.close()
         self.application.statsd.send('foo', 500, 'c')
+        self.application.statsd.flush()
         mock_write.assert_not_called()
 
+    @unittest.mock.patch.object(iostream.IOStream, 'write')
+    def test_metrics_are_written_in_one_batch(self, mock_write):
+        self.application.statsd.send(('foo', 'bar'), 500, 'c')
+        self.application.statsd.send(('foo', 'baz'), 250, 'ms')
+        mock_write.assert_not_called()
+
+        self.application.statsd.flush()
+        mock_write.assert_called_once_with(
+            b'testing.timers.foo.baz:250|ms\ntesting.counters.foo.bar:500|c\n')
+
     @unittest.mock.patch.object(iostream.IOStream, 'write')
     def test_expected_counters_data_written(self, mock_sock):
         path = ('foo', 'bar')
@@ -91,6 +121,7 @@ class TCPStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
                     metric_type)
 
         self.application.statsd.send(path, value, metric_type)
+        self.application.statsd.flush()
         mock_sock.assert_called_once_with(expected.encode())
 
     @unittest.mock.patch.object(iostream.IOStream, 'write')
@@ -104,10 +135,16 @@ class TCPStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
                     metric_type)
 
         self.application.statsd.send(path, value, metric_type)
+        self.application.statsd.flush()
         mock_sock.assert_called_once_with(expected.encode())
 
+    def test_tcp_nodelay_is_set(self):
+        sock = self.application.statsd._sock.socket
+        self.assertTrue(
+            sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+
     def test_tcp_message_format(self):
-        expected = '{path}:{value}|{metric_type}\n'
+        expected = b'%s:%s|%s\n'
         self.assertEqual(self.application.statsd._msg_format, expected)
 
     def test_that_http_method_call_is_recorded(self):
@@ -158,7 +195,7 @@ class TCPStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
     def test_reconnect_logic(self):
         self.application.statsd._tcp_reconnect_sleep = 0.05
         self.application.statsd._sock.close()
-        asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.075))
+        self.io_loop.run_sync(lambda: asyncio.sleep(0.075))
         response = self.fetch('/status_code')
         self.assertEqual(response.code, 200)
 
@@ -196,10 +233,7 @@ class TCPStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
 class TCPStatsdConfigurationTests(testing.AsyncHTTPTestCase):
 
     def get_app(self):
-        self.application = web.Application([
-            web.url('/', examples.statsd.SimpleHandler),
-            web.url('/counters/(.*)/([.0-9]*)', CounterBumper),
-        ])
+        self.application = web.Application(ROUTES)
         return self.application
 
     def setUp(self):
@@ -235,11 +269,7 @@ class TCPStatsdConfigurationTests(testing.AsyncHTTPTestCase):
 class UDPStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
 
     def get_app(self):
-        self.application = web.Application([
-            web.url('/', examples.statsd.SimpleHandler),
-            web.url('/counters/(.*)/([.0-9]*)', CounterBumper),
-            web.url('/status_code', DefaultStatusCode),
-        ])
+        self.application = web.Application(ROUTES)
         return self.application
 
     def setUp(self):
@@ -259,8 +289,13 @@ class UDPStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
         self.statsd.close()
         super().tearDown()
 
-    @unittest.mock.patch.object(socket.socket, 'sendto')
-    def test_expected_counters_data_written(self, mock_sock):
+    def capture_datagrams(self):
+        self.application.statsd._sock.close()
+        self.application.statsd._sock = CapturingSocket()
+        return self.application.statsd._sock
+
+    def test_expected_counters_data_written(self):
+        sink = self.capture_datagrams()
         path = ('foo', 'bar')
         value = 500
         metric_type = 'c'
@@ -270,12 +305,11 @@ class UDPStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
                     metric_type)
 
         self.application.statsd.send(path, value, metric_type)
-        mock_sock.assert_called_once_with(
-                expected.encode(),
-                (self.statsd.sockaddr[0], self.statsd.sockaddr[1]))
+        self.application.statsd.flush()
+        self.assertEqual(sink.datagrams, [expected.encode()])
 
-    @unittest.mock.patch.object(socket.socket, 'sendto')
-    def test_expected_timers_data_written(self, mock_sock):
+    def test_expected_timers_data_written(self):
+        sink = self.capture_datagrams()
         path = ('foo', 'bar')
         value = 500
         metric_type = 'ms'
@@ -285,12 +319,173 @@ class UDPStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
                     metric_type)
 
         self.application.statsd.send(path, value, metric_type)
+        self.application.statsd.flush()
+        self.assertEqual(sink.datagrams, [expected.encode()])
+
+    def test_send_throughput(self):
+        sink = self.capture_datagrams()
+        collector = self.application.statsd
+        for value in range(10000):
+            collector.send(('foo', 'bar'), value, 'ms')
+        collector.flush()
+
+        lines = [line for datagram in sink.datagrams
+                 for line in datagram.split(b'\n')]
+        self.assertEqual(len(lines), 10000)
+        self.assertEqual(lines[-1], b'testing.timers.foo.bar:9999|ms')
+        self.assertLess(len(sink.datagrams), 1000)
+        for datagram in sink.datagrams:
+            self.assertLessEqual(len(datagram), collector.MAX_PAYLOAD)
+
+    @unittest.mock.patch.object(socket.socket, 'send')
+    def test_metrics_are_batched_into_one_datagram(self, mock_sock):
+        self.application.statsd.send(('foo', 'bar'), 500, 'c')
+        self.application.statsd.send(('foo', 'baz'), 250, 'ms')
+        mock_sock.assert_not_called()
+
+        self.application.statsd.flush()
         mock_sock.assert_called_once_with(
-                expected.encode(),
-                (self.statsd.sockaddr[0], self.statsd.sockaddr[1]))
+            b'testing.timers.foo.baz:250|ms\ntesting.counters.foo.bar:500|c')
+
+    @unittest.mock.patch.object(socket.socket, 'send')
+    def test_counters_are_aggregated_until_flush(self, mock_sock):
+        for amount in (1, 2, 3):
+            self.application.statsd.send(('foo', 'bar'), amount, 'c')
+        self.application.statsd.send(('foo', 'baz'), 1, 'c')
+        self.application.statsd.flush()
+        mock_sock.assert_called_once_with(
+            b'testing.counters.foo.bar:6|c\ntesting.counters.foo.baz:1|c')
+
+        mock_sock.reset_mock()
+        self.application.statsd.send(('foo', 'bar'), 1, 'c')
+        self.application.statsd.flush()
+        mock_sock.assert_called_once_with(b'testing.counters.foo.bar:1|c')
+
+    def test_repeated_handler_increments_are_sent_once(self):
+        sink = self.capture_datagrams()
+        handler = statsd.StatsdMixin()
+        handler.application = self.application
+        for _ in range(5):
+            handler.increase_counter('x')
+        self.application.statsd.flush()
+        self.assertEqual(sink.datagrams, [b'testing.counters.x:5|c'])
+
+    @unittest.mock.patch.object(socket.socket, 'send')
+    def test_full_datagram_is_sent_immediately(self, mock_sock):
+        collector = self.application.statsd
+        for _ in range(collector.MAX_PAYLOAD):
+            collector.send(('foo', 'bar'), 500, 'ms')
+        self.assertGreaterEqual(mock_sock.call_count, 1)
+        for call in mock_sock.call_args_list:
+            self.assertLessEqual(len(call[0][0]), collector.MAX_PAYLOAD)
+
+    @unittest.mock.patch.object(socket.socket, 'send')
+    def test_max_payload_is_configurable(self, mock_sock):
+        collector = statsd.StatsDCollector(
+            self.statsd.sockaddr[0], self.statsd.sockaddr[1],
+            namespace=self.namespace, max_payload=64)
+        self.addCleanup(collector.close)
+        for _ in range(64):
+            collector.send(('foo', 'bar'), 500, 'ms')
+        self.assertGreaterEqual(mock_sock.call_count, 1)
+        for call in mock_sock.call_args_list:
+            self.assertLessEqual(len(call[0][0]), 64)
+
+    @unittest.mock.patch.object(socket.socket, 'send')
+    def test_datagram_is_dropped_when_send_would_block(self, mock_sock):
+        mock_sock.side_effect = BlockingIOError
+        self.application.statsd.send(('foo', 'bar'), 500, 'c')
+        with self.assertLogs(statsd.LOGGER, 'WARNING'):
+            self.application.statsd.flush()
+        self.assertEqual(self.application.statsd._dropped, 1)
+
+        self.application.statsd.send(('foo', 'bar'), 500, 'c')
+        self.application.statsd.flush()
+        self.assertEqual(self.application.statsd._dropped, 2)
+
+    def test_datagram_is_dropped_when_agent_is_not_listening(self):
+        closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        closed.bind(('127.0.0.1', 0))
+        host, port = closed.getsockname()
+        closed.close()
+        collector = statsd.StatsDCollector(host, port,
+                                           namespace=self.namespace)
+        self.addCleanup(collector.close)
+
+        with self.assertLogs(statsd.LOGGER, 'DEBUG') as context:
+            for _ in range(4):
+                collector.send(('foo', 'bar'), 1, 'ms')
+                collector.flush()
+                self.io_loop.run_sync(lambda: asyncio.sleep(0.01))
+        self.assertGreater(collector._dropped, 0)
+        self.assertEqual(
+            [record for record in context.records
+             if record.levelno >= logging.ERROR], [])
+
+    def test_buffered_metrics_are_flushed_after_interval(self):
+        self.application.statsd.send(('foo', 'bar'), 500, 'c')
+        self.assertEqual(self.statsd.datagrams, [])
+
+        self.io_loop.run_sync(lambda: asyncio.sleep(
+            self.application.statsd._flush_interval * 2))
+        self.assertEqual(self.statsd.datagrams,
+                         [b'testing.counters.foo.bar:500|c'])
+
+    @testing.gen_test
+    async def test_that_sends_from_other_threads_are_delivered(self):
+        collector = self.application.statsd
+        await self.io_loop.run_in_executor(
+            None, collector.send, ('thread', 'first'), 1, 'ms')
+        collector.send(('loop',), 2, 'ms')
+        await self.io_loop.run_in_executor(
+            None, collector.send, ('thread', 'second'), 3, 'ms')
+
+        await asyncio.sleep(collector._flush_interval * 2)
+        for path, value in (('thread.first', '1'), ('loop', '2'),
+                            ('thread.second', '3')):
+            self.assertEqual(
+                list(self.statsd.find_metrics('testing.timers.' + path,
+                                              'ms')),
+                [('testing.timers.' + path, value, 'ms')])
+        self.assertEqual(collector._buffer, b'')
+
+    @unittest.mock.patch.object(socket.socket, 'send')
+    def test_path_elements_are_normalized(self, mock_sock):
+        self.application.statsd.send(('a.b', 1, 1.0, True, ['c']), 1, 'c')
+        self.application.statsd.flush()
+        mock_sock.assert_called_once_with(
+            b"testing.counters.a-b.1.1-0.True.['c']:1|c")
+
+    def test_that_only_str_and_int_elements_are_cached(self):
+        class Element:
+            name = 'before'
+
+            def __str__(self):
+                return self.name
+
+        element = Element()
+        collector = self.application.statsd
+        self.assertEqual(collector._build_path(('x', element), 'c'),
+                         b'testing.counters.x.before')
+        element.name = 'after'
+        self.assertEqual(collector._build_path(('x', element), 'c'),
+                         b'testing.counters.x.after')
+
+    def test_udp_socket_is_non_blocking(self):
+        self.assertFalse(self.application.statsd._sock.getblocking())
+
+    def test_udp_socket_is_connected_on_first_flush(self):
+        collector = self.application.statsd
+        self.assertFalse(collector._connected)
+
+        collector.send(('foo', 'bar'), 1, 'ms')
+        collector.flush()
+        self.assertTrue(collector._connected)
+        self.assertEqual(collector._sock.getpeername(),
+                         self.statsd.sockaddr)
 
     def test_udp_message_format(self):
-        expected = '{path}:{value}|{metric_type}'
+        expected = b'%s:%s|%s'
         self.assertEqual(self.application.statsd._msg_format, expected)
 
     def test_that_http_method_call_is_recorded(self):
@@ -325,6 +520,18 @@ class UDPStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
         for path, value, stat_type in self.statsd.find_metrics(prefix, 'ms'):
             assert_between(250.0, float(value), 300.0)
 
+    def test_that_execution_timer_records_when_block_raises(self):
+        handler = statsd.StatsdMixin()
+        handler.application = self.application
+        with self.assertRaises(RuntimeError):
+            with handler.execution_timer('failure'):
+                raise RuntimeError
+        self.application.statsd.flush()
+        self.io_loop.run_sync(lambda: asyncio.sleep(0.05))
+        self.assertEqual(
+            len(list(self.statsd.find_metrics('testing.timers.failure',
+                                              'ms'))), 1)
+
     def test_that_add_metric_tag_is_ignored(self):
         response = self.fetch('/',
                               headers={'Correlation-ID': 'does not matter'})
@@ -338,6 +545,64 @@ class UDPStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
         self.assertEqual(expected,
                          list(self.statsd.find_metrics(expected, 'ms'))[0][0])
 
+    def test_that_request_metrics_share_one_datagram(self):
+        response = self.fetch('/counters/path/5', method='POST', body='')
+        self.assertEqual(response.code, 204)
+
+        self.assertEqual(len(self.statsd.datagrams), 1)
+        lines = self.statsd.datagrams[0].split(b'\n')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith(
+            b'testing.timers.CounterBumper.POST.204:'))
+        self.assertEqual(lines[1], b'testing.counters.path:5|c')
+
+    @testing.gen_test
+    async def test_that_concurrent_requests_are_all_recorded(self):
+        responses = await asyncio.gather(*[
+            self.http_client.fetch(self.get_url('/status_code'))
+            for _ in range(32)])
+        self.assertEqual({response.code for response in responses}, {200})
+        await asyncio.sleep(0.05)
+
+        expected = 'testing.timers.DefaultStatusCode.GET.200'
+        self.assertEqual(len(list(self.statsd.find_metrics(expected, 'ms'))),
+                         32)
+
+    def test_that_find_metrics_sees_new_datagrams(self):
+        self.fetch('/status_code')
+        expected = 'testing.timers.DefaultStatusCode.GET.200'
+        self.assertEqual(len(list(self.statsd.find_metrics(expected, 'ms'))),
+                         1)
+
+        self.fetch('/status_code')
+        self.assertEqual(len(list(self.statsd.find_metrics(expected, 'ms'))),
+                         2)
+
+        self.statsd.datagrams.clear()
+        with self.assertRaises(AssertionError):
+            list(self.statsd.find_metrics(expected, 'ms'))
+
+    def test_that_find_metrics_sees_refilled_datagrams(self):
+        self.statsd.datagrams.append(b'a.old:1|c')
+        self.assertEqual(list(self.statsd.find_metrics('a.', 'c')),
+                         [('a.old', '1', 'c')])
+
+        self.statsd.datagrams.clear()
+        self.statsd.datagrams.extend([b'a.new:1|c', b'a.new:2|c'])
+        self.assertEqual(list(self.statsd.find_metrics('a.', 'c')),
+                         [('a.new', '1', 'c'), ('a.new', '2', 'c')])
+
+        self.statsd.datagrams[0] = b'a.replaced:3|c'
+        self.assertEqual(list(self.statsd.find_metrics('a.', 'c')),
+                         [('a.replaced', '3', 'c'), ('a.new', '2', 'c')])
+
+        self.statsd.datagrams = [b'a.other:4|c']
+        self.statsd.datagrams += [b'a.other:5|c']
+        self.statsd.datagrams.append(b'a.last:6|c')
+        self.assertEqual(list(self.statsd.find_metrics('a.', 'c')),
+                         [('a.other', '4', 'c'), ('a.other', '5', 'c'),
+                          ('a.last', '6', 'c')])
+
     def test_that_mixin_works_without_client(self):
         self.application.statsd.close()
         delattr(self.application, 'statsd')
@@ -345,14 +610,22 @@ class UDPStatsdMetricCollectionTests(testing.AsyncHTTPTestCase):
         response = self.fetch('/', method='POST', body='')
         self.assertEqual(response.code, 204)
 
+    def test_that_record_timing_is_called_without_client(self):
+        self.application.statsd.close()
+        delattr(self.application, 'statsd')
+
+        with unittest.mock.patch.object(DefaultStatusCode,
+                                        'record_timing') as record_timing:
+            response = self.fetch('/status_code')
+        self.assertEqual(response.code, 200)
+        record_timing.assert_called_once_with(
+            unittest.mock.ANY, 'DefaultStatusCode', 'GET', 200)
+
 
 class UDPStatsdConfigurationTests(testing.AsyncHTTPTestCase):
 
     def get_app(self):
-        self.application = web.Application([
-            web.url('/', examples.statsd.SimpleHandler),
-            web.url('/counters/(.*)/([.0-9]*)', CounterBumper),
-        ])
+        self.application = web.Application(ROUTES)
         return self.application
 
     def setUp(self):
@@ -389,6 +662,50 @@ class UDPStatsdConfigurationTests(testing.AsyncHTTPTestCase):
             self.assertEqual(int(value), 5)
 
 
+class StatsdCollectorIOLoopTests(unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.collector = statsd.StatsDCollector('127.0.0.1', 8125,
+                                                namespace='testing')
+        self.collector._sock.close()
+        self.sink = self.collector._sock = CapturingSocket()
+        self.addCleanup(self.collector.close)
+
+    def run_on_new_io_loop(self, func):
+        io_loop = ioloop.IOLoop()
+        try:
+            io_loop.run_sync(func)
+        finally:
+            io_loop.close()
+
+    def test_that_collector_survives_successive_io_loops(self):
+        async def first():
+            self.collector.send(('first',), 1, 'ms')
+            self.collector.flush()
+            self.collector.send(('a',), 1, 'c')
+
+        async def second():
+            self.collector.send(('second',), 2, 'ms')
+            self.collector.send(('b',), 3, 'c')
+            await asyncio.sleep(self.collector._flush_interval * 2)
+
+        self.run_on_new_io_loop(first)
+        self.assertEqual(self.sink.datagrams, [b'testing.timers.first:1|ms'])
+
+        self.run_on_new_io_loop(second)
+        self.assertEqual(self.sink.datagrams[1:], [
+            b'testing.timers.second:2|ms\n'
+            b'testing.counters.a:1|c\n'
+            b'testing.counters.b:3|c'])
+        self.assertEqual(self.collector._buffer, b'')
+        self.assertEqual(self.collector._counters, {})
+
+    def test_that_metrics_are_written_without_an_io_loop(self):
+        self.collector.send(('foo',), 1, 'c')
+        self.assertEqual(self.sink.datagrams, [b'testing.counters.foo:1|c'])
+
+
 class StatsdInstallationTests(unittest.TestCase):
 
     def setUp(self):
@@ -408,6 +725,13 @@ class StatsdInstallationTests(unittest.TestCase):
         statsd.install(self.application, **{'port': '8888'})
         self.assertEqual(self.application.statsd._port, 8888)
 
+    def test_send_buffer_size_is_used(self):
+        statsd.install(self.application, **{'send_buffer_size': 65536})
+        sock = self.application.statsd._sock
+        # Linux doubles the requested size to allow for bookkeeping
+        self.assertIn(sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+                      (65536, 2 * 65536))
+
     def test_default_host_and_port_is_used(self):
         statsd.install(self.application, **{'namespace': 'testing'})
         self.assertEqual(self.application.statsd._host, '127.0.0.1')